@@ -4,11 +4,13 @@
 # LICENSE file in the root directory of this source tree.
 
 import csv
+import math
+import re
 from pathlib import Path
 import zipfile
-from functools import reduce
+from functools import lru_cache, reduce
 from multiprocessing import cpu_count
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 import io
 
 import numpy as np
@@ -19,9 +21,28 @@ from fairseq.data.audio.audio_utils import (
     is_sf_audio_data
 )
 import torch
+import torch.nn.functional as F
 import soundfile as sf
 from tqdm import tqdm
 
+try:
+    import numba
+    from numba import njit, prange
+
+    has_numba = True
+except ImportError:
+    has_numba = False
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+
+    pa_csv.WriteOptions(quoting_style="none")  # pyarrow>=12
+    has_pyarrow = True
+except (ImportError, TypeError):
+    has_pyarrow = False
+
 
 UNK_TOKEN, UNK_TOKEN_ID = "<unk>", 3
 BOS_TOKEN, BOS_TOKEN_ID = "<s>", 0
@@ -30,26 +51,34 @@ PAD_TOKEN, PAD_TOKEN_ID = "<pad>", 1
 
 
 def gen_vocab(
-    input_path: Path, output_path_prefix: Path, model_type="bpe",
-    vocab_size=1000, special_symbols: Optional[List[str]] = None
+    input_path: Optional[Path], output_path_prefix: Path, model_type="bpe",
+    vocab_size=1000, special_symbols: Optional[List[str]] = None,
+    sentences: Optional[Iterable[str]] = None,
 ):
-    # Train SentencePiece Model
-    arguments = [
-        f"--input={input_path.as_posix()}",
-        f"--model_prefix={output_path_prefix.as_posix()}",
-        f"--model_type={model_type}",
-        f"--vocab_size={vocab_size}",
-        "--character_coverage=1.0",
-        f"--num_threads={cpu_count()}",
-        f"--unk_id={UNK_TOKEN_ID}",
-        f"--bos_id={BOS_TOKEN_ID}",
-        f"--eos_id={EOS_TOKEN_ID}",
-        f"--pad_id={PAD_TOKEN_ID}",
-    ]
+    # Train SentencePiece Model (on `sentences` in memory if given, instead
+    # of the text file at `input_path`)
+    arguments = {
+        "model_prefix": output_path_prefix.as_posix(),
+        "model_type": model_type,
+        "vocab_size": vocab_size,
+        "character_coverage": 1.0,
+        "num_threads": cpu_count(),
+        "unk_id": UNK_TOKEN_ID,
+        "bos_id": BOS_TOKEN_ID,
+        "eos_id": EOS_TOKEN_ID,
+        "pad_id": PAD_TOKEN_ID,
+    }
     if special_symbols is not None:
-        _special_symbols = ",".join(special_symbols)
-        arguments.append(f"--user_defined_symbols={_special_symbols}")
-    sp.SentencePieceTrainer.Train(" ".join(arguments))
+        arguments["user_defined_symbols"] = ",".join(special_symbols)
+    if sentences is not None:
+        sp.SentencePieceTrainer.Train(
+            sentence_iterator=iter(sentences), **arguments
+        )
+    else:
+        arguments["input"] = input_path.as_posix()
+        sp.SentencePieceTrainer.Train(
+            " ".join(f"--{k}={v}" for k, v in arguments.items())
+        )
     # Export fairseq dictionary
     spm = sp.SentencePieceProcessor()
     spm.Load(output_path_prefix.as_posix() + ".model")
@@ -70,27 +99,114 @@ def gen_vocab(
             f_out.write(f"{s} 1\n")
 
 
+@lru_cache(maxsize=8)
+def _get_kaldi_mel_banks(
+    n_bins: int, n_fft: int, sample_rate: int, low_freq: float = 20.0
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Kaldi triangular mel filters (n_bins x n_fft // 2 + 1) along with the
+    first and last non-zero FFT bin of each filter."""
+    def mel_scale(freq):
+        return 1127.0 * np.log(1.0 + freq / 700.0)
+
+    mel_low, mel_high = mel_scale(low_freq), mel_scale(0.5 * sample_rate)
+    mel_delta = (mel_high - mel_low) / (n_bins + 1)
+    left_mel = mel_low + np.arange(n_bins)[:, None] * mel_delta
+    center_mel, right_mel = left_mel + mel_delta, left_mel + 2 * mel_delta
+    mel = mel_scale(sample_rate / n_fft * np.arange(n_fft // 2))[None, :]
+    up_slope = (mel - left_mel) / (center_mel - left_mel)
+    down_slope = (right_mel - mel) / (right_mel - center_mel)
+    filters = np.zeros((n_bins, n_fft // 2 + 1), dtype=np.float32)
+    filters[:, :-1] = np.maximum(0.0, np.minimum(up_slope, down_slope))
+    nonzero = filters > 0
+    starts = nonzero.argmax(axis=1)
+    ends = filters.shape[1] - nonzero[:, ::-1].argmax(axis=1)
+    return filters, starts, ends
+
+
+if has_numba:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _apply_log_mel_banks(power_spec, filters, starts, ends, eps, out):
+        for t in prange(power_spec.shape[0]):
+            for m in range(filters.shape[0]):
+                s = 0.0
+                for k in range(starts[m], ends[m]):
+                    s += power_spec[t, k] * filters[m, k]
+                out[t, m] = math.log(max(s, eps))
+
+
+def set_numba_num_threads(n_threads: int) -> None:
+    """Cap the threads of the parallel Numba kernels, e.g. in each worker of
+    a process pool so that the workers do not oversubscribe the CPUs."""
+    if has_numba:
+        numba.set_num_threads(
+            max(1, min(n_threads, numba.config.NUMBA_NUM_THREADS))
+        )
+
+
+def _get_numba_fbank(
+    waveform: np.ndarray, sample_rate: int, n_bins=80
+) -> Optional[np.ndarray]:
+    """Get mel-filter bank features with a Numba kernel for the mel filtering.
+    Follows the Kaldi defaults of TorchAudio (25ms Povey window, 10ms shift,
+    no dither, DC removal, pre-emphasis 0.97, power spectrum)."""
+    if not has_numba:
+        return None
+    waveform = waveform.reshape(-1).astype(np.float64)
+    window_size = int(sample_rate * 25.0 * 0.001)
+    window_shift = int(sample_rate * 10.0 * 0.001)
+    n_fft = 1 << (window_size - 1).bit_length()
+    n_frames = 0
+    if len(waveform) >= window_size:
+        n_frames = 1 + (len(waveform) - window_size) // window_shift
+    frames = np.lib.stride_tricks.as_strided(
+        waveform,
+        shape=(n_frames, window_size),
+        strides=(window_shift * waveform.strides[0], waveform.strides[0]),
+    )
+    frames = frames - frames.mean(axis=1, keepdims=True)
+    frames = frames - 0.97 * np.concatenate(
+        [frames[:, :1], frames[:, :-1]], axis=1
+    )
+    frames *= np.power(np.hanning(window_size), 0.85)
+    spectrum = np.fft.rfft(frames, n=n_fft)
+    power_spec = (spectrum.real ** 2 + spectrum.imag ** 2).astype(np.float32)
+
+    filters, starts, ends = _get_kaldi_mel_banks(n_bins, n_fft, sample_rate)
+    features = np.empty((n_frames, n_bins), dtype=np.float32)
+    eps = float(np.finfo(np.float32).eps)
+    _apply_log_mel_banks(power_spec, filters, starts, ends, eps, features)
+    return features
+
+
 def extract_fbank_features(
-    waveform: torch.FloatTensor,
+    waveform: Union[np.ndarray, torch.FloatTensor],
     sample_rate: int,
     output_path: Optional[Path] = None,
     n_mel_bins: int = 80,
     overwrite: bool = False,
 ):
+    """Extract Kaldi-compatible log mel filter bank features. The backends
+    are tried in the order pyKaldi, Numba, torchaudio: when Numba is
+    installed it takes precedence over torchaudio, whose output it matches
+    up to float32 rounding."""
     if output_path is not None and output_path.is_file() and not overwrite:
         return
 
     _waveform, _ = convert_waveform(waveform, sample_rate, to_mono=True)
     # Kaldi compliance: 16-bit signed integers
     _waveform = _waveform * (2 ** 15)
-    _waveform = _waveform.numpy()
+    if isinstance(_waveform, torch.Tensor):
+        _waveform = _waveform.numpy()
 
     features = _get_kaldi_fbank(_waveform, sample_rate, n_mel_bins)
+    if features is None:
+        features = _get_numba_fbank(_waveform, sample_rate, n_mel_bins)
     if features is None:
         features = _get_torchaudio_fbank(_waveform, sample_rate, n_mel_bins)
     if features is None:
         raise ImportError(
-            "Please install pyKaldi or torchaudio to enable fbank feature extraction"
+            "Please install pyKaldi, Numba or torchaudio to enable fbank "
+            "feature extraction"
         )
 
     if output_path is not None:
@@ -98,14 +214,73 @@ def extract_fbank_features(
     return features
 
 
+def extract_fbank_features_batch(
+    waveforms: List[torch.FloatTensor],
+    sample_rate: int,
+    n_mel_bins: int = 80,
+    device: str = "cuda",
+) -> List[np.ndarray]:
+    """Batched counterpart of `extract_fbank_features` for waveforms sharing
+    one sample rate. The waveforms are zero-padded into one batch and the
+    Kaldi-compatible filter bank is computed on `device`; padded frames are
+    dropped from the outputs."""
+    window_size = int(sample_rate * 25.0 * 0.001)
+    window_shift = int(sample_rate * 10.0 * 0.001)
+    n_fft = 1 << (window_size - 1).bit_length()
+    n_frames = [
+        max(0, 1 + (w.shape[-1] - window_size) // window_shift)
+        for w in waveforms
+    ]
+
+    batch = torch.nn.utils.rnn.pad_sequence(
+        [w.mean(dim=0) if w.dim() > 1 else w for w in waveforms],
+        batch_first=True,
+    )
+    batch = F.pad(batch, (0, max(0, window_size - batch.shape[1])))
+    if torch.device(device).type == "cuda":
+        batch = batch.pin_memory()
+    # Kaldi compliance: 16-bit signed integers
+    batch = batch.to(device, non_blocking=True) * (2 ** 15)
+
+    frames = batch.unfold(1, window_size, window_shift)
+    frames = frames - frames.mean(dim=2, keepdim=True)
+    frames = frames - 0.97 * F.pad(frames, (1, 0), mode="replicate")[..., :-1]
+    window = torch.hann_window(
+        window_size, periodic=False, dtype=frames.dtype, device=frames.device
+    ).pow(0.85)
+    spectrum = torch.fft.rfft(frames * window, n=n_fft).abs().pow(2)
+    filters, _, _ = _get_kaldi_mel_banks(n_mel_bins, n_fft, sample_rate)
+    filters = torch.from_numpy(filters).to(frames.device)
+    features = torch.matmul(spectrum, filters.t())
+    features = features.clamp_min(torch.finfo(features.dtype).eps).log()
+    features = features.cpu().numpy()
+    return [features[i, :n] for i, n in enumerate(n_frames)]
+
+
 def create_zip(data_root: Path, zip_path: Path):
     paths = list(data_root.glob("*.npy"))
     paths.extend(data_root.glob("*.flac"))
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as f:
+    # Entries must stay uncompressed: manifests address them by raw byte
+    # offsets and the data loader reads them back with mmap
+    with zipfile.ZipFile(
+        zip_path, "w", compression=zipfile.ZIP_STORED, allowZip64=True
+    ) as f:
         for path in tqdm(paths):
             f.write(path, arcname=path.name)
 
 
+def add_npy_to_zip(
+        zip_file: zipfile.ZipFile, name: str, array: np.ndarray
+) -> Tuple[int, int]:
+    """Serialize `array` as an NPY entry of an open (stored) ZIP file and
+    return the byte offset and length of the entry data in the archive."""
+    buffer = io.BytesIO()
+    np.lib.format.write_array(buffer, array, allow_pickle=False)
+    zip_file.writestr(name, buffer.getvalue())
+    info = zip_file.getinfo(name)
+    return info.header_offset + 30 + len(info.filename), info.file_size
+
+
 def get_zip_manifest(
         zip_path: Path, zip_root: Optional[Path] = None, is_audio=False
 ):
@@ -113,23 +288,28 @@ def get_zip_manifest(
     with zipfile.ZipFile(_zip_path, mode="r") as f:
         info = f.infolist()
     paths, lengths = {}, {}
-    for i in tqdm(info):
-        utt_id = Path(i.filename).stem
-        offset, file_size = i.header_offset + 30 + len(i.filename), i.file_size
-        paths[utt_id] = f"{zip_path.as_posix()}:{offset}:{file_size}"
-        with open(_zip_path, "rb") as f:
+    with open(_zip_path, "rb") as f:
+        for i in tqdm(info):
+            assert i.compress_type == zipfile.ZIP_STORED, i
+            utt_id = Path(i.filename).stem
+            offset, file_size = i.header_offset + 30 + len(i.filename), i.file_size
+            paths[utt_id] = f"{zip_path.as_posix()}:{offset}:{file_size}"
             f.seek(offset)
-            byte_data = f.read(file_size)
-            assert len(byte_data) > 1
             if is_audio:
+                byte_data = f.read(file_size)
+                assert len(byte_data) > 1
                 assert is_sf_audio_data(byte_data), i
+                lengths[utt_id] = sf.info(io.BytesIO(byte_data)).frames
             else:
-                assert is_npy_data(byte_data), i
-            byte_data_fp = io.BytesIO(byte_data)
-            if is_audio:
-                lengths[utt_id] = sf.info(byte_data_fp).frames
-            else:
-                lengths[utt_id] = np.load(byte_data_fp).shape[0]
+                # Only the NPY header is needed to know the number of frames
+                assert file_size > 1 and is_npy_data(f.read(2)), i
+                f.seek(offset)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, _, _ = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, _ = np.lib.format.read_array_header_2_0(f)
+                lengths[utt_id] = shape[0]
     return paths, lengths
 
 
@@ -215,8 +395,48 @@ def load_df_from_tsv(path: Union[str, Path]) -> pd.DataFrame:
     )
 
 
+def _get_plain_tsv_table(dataframe) -> Optional["pa.Table"]:
+    """Convert `dataframe` to an Arrow table if writing it as TSV needs no
+    escaping and no float formatting, i.e. all columns are integers or
+    non-null strings free of delimiters, line breaks, quotes and
+    backslashes. Returns None otherwise."""
+    special_chars = r'[\t\n\r"\\]'
+    if any(re.search(special_chars, str(c)) for c in dataframe.columns):
+        return None
+    try:
+        table = pa.Table.from_pandas(dataframe, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+    for column in table.columns:
+        if pa.types.is_integer(column.type):
+            continue
+        is_string = pa.types.is_string(column.type) or pa.types.is_large_string(
+            column.type
+        )
+        if not is_string or column.null_count > 0:
+            return None
+        if pc.any(pc.match_substring_regex(column, special_chars)).as_py():
+            return None
+    return table
+
+
 def save_df_to_tsv(dataframe, path: Union[str, Path]):
     _path = path if isinstance(path, str) else path.as_posix()
+    table = _get_plain_tsv_table(dataframe) if has_pyarrow else None
+    if table is not None:
+        # Vectorized C++ writer; produces the same bytes as `to_csv` below
+        # when there is nothing to escape
+        with open(_path, "wb") as f:
+            header = "\t".join(map(str, dataframe.columns))
+            f.write((header + "\n").encode("utf-8"))
+            pa_csv.write_csv(
+                table,
+                f,
+                write_options=pa_csv.WriteOptions(
+                    include_header=False, delimiter="\t", quoting_style="none"
+                ),
+            )
+        return
     dataframe.to_csv(
         _path,
         sep="\t",
@@ -242,16 +462,38 @@ def load_tsv_to_dicts(path: Union[str, Path]) -> List[dict]:
     return rows
 
 
-def filter_manifest_df(
-    df, is_train_split=False, extra_filters=None, min_n_frames=5, max_n_frames=3000
+def get_manifest_speech_filters(
+    df, is_train_split=False, min_n_frames=5, max_n_frames=3000
 ):
+    """The filters of `filter_manifest_df` that only depend on the speech,
+    and hence can be shared between manifests that differ in target text."""
     filters = {
         "no speech": df["audio"] == "",
         f"short speech (<{min_n_frames} frames)": df["n_frames"] < min_n_frames,
-        "empty sentence": df["tgt_text"] == "",
     }
     if is_train_split:
         filters[f"long speech (>{max_n_frames} frames)"] = df["n_frames"] > max_n_frames
+    return filters
+
+
+def filter_manifest_df(
+    df, is_train_split=False, extra_filters=None, min_n_frames=5, max_n_frames=3000,
+    speech_filters=None
+):
+    """Filter out invalid manifest rows and print a summary of the filters.
+    `speech_filters` are precomputed filters from
+    `get_manifest_speech_filters`; when given, `is_train_split`,
+    `min_n_frames` and `max_n_frames` are ignored."""
+    if speech_filters is None:
+        speech_filters = get_manifest_speech_filters(
+            df, is_train_split, min_n_frames, max_n_frames
+        )
+    # Keep the summary order: no speech, short speech, empty sentence and
+    # then long speech (train splits only)
+    speech_filters = list(speech_filters.items())
+    filters = dict(speech_filters[:2])
+    filters["empty sentence"] = df["tgt_text"] == ""
+    filters.update(speech_filters[2:])
     if extra_filters is not None:
         filters.update(extra_filters)
     invalid = reduce(lambda x, y: x | y, filters.values())
@@ -274,6 +516,39 @@ def cal_gcmvn_stats(features_list):
     return {"mean": mean.astype("float32"), "std": std.astype("float32")}
 
 
+class GcmvnStatsAccumulator(object):
+    """Single-pass estimation of global CMVN stats: per-utterance moments are
+    merged into running ones (Welford/Chan), so the features do not have to be
+    kept in memory."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, features: np.ndarray):
+        n = features.shape[0]
+        if n == 0:
+            return
+        features = features.astype(np.float64)
+        mean = features.mean(axis=0)
+        m2 = ((features - mean) ** 2).sum(axis=0)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = n, mean, m2
+            return
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+    def get_stats(self):
+        if self.count == 0:
+            raise ValueError("No features were accumulated for GCMVN stats")
+        std = np.sqrt(np.maximum(self.m2 / self.count, 1e-8))
+        return {"mean": self.mean.astype("float32"), "std": std.astype("float32")}
+
+
 class S2TDataConfigWriter(object):
     DEFAULT_VOCAB_FILENAME = "dict.txt"
     DEFAULT_INPUT_FEAT_PER_CHANNEL = 80
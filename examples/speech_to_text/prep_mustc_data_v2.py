@@ -6,26 +6,33 @@
 
 import argparse
 import logging
+import multiprocessing as mp
 import os
 from pathlib import Path
 import shutil
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from itertools import groupby
-from tempfile import NamedTemporaryFile, TemporaryDirectory
-from typing import Tuple
+from operator import itemgetter
+from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
 import soundfile as sf
 from examples.speech_to_text.data_utils import (
-    create_zip,
+    add_npy_to_zip,
     extract_fbank_features,
+    extract_fbank_features_batch,
     filter_manifest_df,
     gen_config_yaml,
+    get_manifest_speech_filters,
     gen_vocab,
     get_zip_manifest,
     load_df_from_tsv,
     save_df_to_tsv,
-    cal_gcmvn_stats,
+    set_numba_num_threads,
+    GcmvnStatsAccumulator,
 )
 import torch
 from torch.utils.data import Dataset
@@ -38,6 +45,10 @@ log = logging.getLogger(__name__)
 
 
 MANIFEST_COLUMNS = ["id", "audio", "n_frames", "tgt_text", "speaker"]
+# Raw array data of each NPY entry in fbank80.zip, for loaders that read it
+# without parsing the NPY header, e.g. `np.frombuffer(mmap, dtype,
+# count=n_frames * n_mels, offset=offset).reshape(n_frames, n_mels)`
+ZIP_INDEX_COLUMNS = ["id", "offset", "n_frames", "n_mels", "dtype"]
 
 
 class MUSTC(Dataset):
@@ -60,8 +71,11 @@ class MUSTC(Dataset):
             import yaml
         except ImportError:
             print("Please install PyYAML to load the MuST-C YAML files")
+        # Prefer the libyaml-based loader. Keep the base (all-strings) schema:
+        # segments are sorted by their offset strings, which fixes the IDs
+        yaml_loader = getattr(yaml, "CBaseLoader", yaml.BaseLoader)
         with open(txt_root / f"{split}.yaml") as f:
-            segments = yaml.load(f, Loader=yaml.BaseLoader)
+            segments = yaml.load(f, Loader=yaml_loader)
         # Load source and target utterances
         for _lang in ["en", lang]:
             with open(txt_root / f"{split}.{_lang}") as f:
@@ -69,21 +83,38 @@ class MUSTC(Dataset):
             assert len(segments) == len(utterances)
             for i, u in enumerate(utterances):
                 segments[i][_lang] = u
+        # Query sample rates of all wav files concurrently (I/O-bound)
+        wav_filenames = list({s["wav"] for s in segments})
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            sample_rates = executor.map(
+                lambda x: sf.info((wav_root / x).as_posix()).samplerate,
+                wav_filenames
+            )
+            sample_rate_map = dict(zip(wav_filenames, sample_rates))
         # Gather info
         self.data = []
         for wav_filename, _seg_group in groupby(segments, lambda x: x["wav"]):
             wav_path = wav_root / wav_filename
-            sample_rate = sf.info(wav_path.as_posix()).samplerate
+            sample_rate = sample_rate_map[wav_filename]
             seg_group = sorted(_seg_group, key=lambda x: x["offset"])
+            # Convert the offsets and durations of the group all at once
+            offsets = np.fromiter(
+                (float(s["offset"]) for s in seg_group),
+                dtype=np.float64, count=len(seg_group)
+            )
+            durations = np.fromiter(
+                (float(s["duration"]) for s in seg_group),
+                dtype=np.float64, count=len(seg_group)
+            )
+            offsets = (offsets * sample_rate).astype(np.int64).tolist()
+            durations = (durations * sample_rate).astype(np.int64).tolist()
             for i, segment in enumerate(seg_group):
-                offset = int(float(segment["offset"]) * sample_rate)
-                n_frames = int(float(segment["duration"]) * sample_rate)
                 _id = f"{wav_path.stem}_{i}"
                 self.data.append(
                     (
                         wav_path.as_posix(),
-                        offset,
-                        n_frames,
+                        offsets[i],
+                        durations[i],
                         sample_rate,
                         segment["en"],
                         segment[lang],
@@ -92,130 +123,303 @@ class MUSTC(Dataset):
                     )
                 )
 
-    def __getitem__(self, n: int) -> Tuple[torch.Tensor, int, str, str, str, str]:
-        wav_path, offset, n_frames, sr, src_utt, tgt_utt, spk_id, utt_id = self.data[n]
+    def get_waveform_np(self, n: int) -> np.ndarray:
+        wav_path, offset, n_frames = self.data[n][:3]
         waveform, _ = get_waveform(wav_path, frames=n_frames, start=offset)
-        waveform = torch.from_numpy(waveform)
+        return waveform
+
+    def __getitem__(self, n: int) -> Tuple[torch.Tensor, int, str, str, str, str]:
+        _, _, _, sr, src_utt, tgt_utt, spk_id, utt_id = self.data[n]
+        waveform = torch.from_numpy(self.get_waveform_np(n))
         return waveform, sr, src_utt, tgt_utt, spk_id, utt_id
 
     def __len__(self) -> int:
         return len(self.data)
 
+    def iter_meta(self):
+        """Iterate over the utterance metadata without decoding audio. Each
+        item is a tuple of the form: utterance_id, n_frames, sample_rate,
+        source utterance, target utterance, speaker_id"""
+        for _, _, n_frames, sr, src_utt, tgt_utt, spk_id, utt_id in self.data:
+            yield utt_id, n_frames, sr, src_utt, tgt_utt, spk_id
 
-def process(args):
+
+def _read_wav(items: List[Tuple]) -> List[Tuple[str, int, np.ndarray]]:
+    # Receives the `MUSTC.data` tuples of all segments of one wav file rather
+    # than indices, so that the dataset itself never has to be pickled to the
+    # workers, and reads them through a single open file handle
+    outputs = []
+    with sf.SoundFile(items[0][0]) as f:
+        for _, offset, n_frames, sample_rate, _, _, _, utt_id in items:
+            f.seek(offset)
+            waveform = f.read(n_frames, dtype="float32", always_2d=True).T
+            outputs.append((utt_id, sample_rate, waveform))
+    return outputs
+
+
+def _extract_wav(items: List[Tuple]) -> List[Tuple[str, np.ndarray]]:
+    return [
+        (utt_id, extract_fbank_features(waveform, sample_rate))
+        for utt_id, sample_rate, waveform in _read_wav(items)
+    ]
+
+
+def _init_worker(n_threads: int) -> None:
+    # Both the Numba and the torchaudio fbank default to all cores, which
+    # oversubscribes the CPUs once several worker processes run them
+    n_threads = max(1, n_threads)
+    torch.set_num_threads(n_threads)
+    set_numba_num_threads(n_threads)
+
+
+def _iter_prefetched(fn, items: List, n_prefetch: int = 2):
+    # Runs `fn` on the next `n_prefetch` items in background threads while the
+    # caller consumes the current result. Threads suffice for overlapping
+    # audio decoding with feature extraction, as libsndfile releases the GIL.
+    with ThreadPoolExecutor(n_prefetch) as executor:
+        futures = deque(executor.submit(fn, x) for x in items[:n_prefetch])
+        for i in range(len(items)):
+            result = futures.popleft().result()
+            if i + n_prefetch < len(items):
+                futures.append(executor.submit(fn, items[i + n_prefetch]))
+            yield result
+
+
+def _extract_gpu_batch(
+    batch: List[Tuple[str, int, np.ndarray]]
+) -> List[Tuple[str, np.ndarray]]:
+    utt_ids, sample_rates, waveforms = zip(*batch)
+    features = extract_fbank_features_batch(
+        [torch.from_numpy(w) for w in waveforms], sample_rates[0]
+    )
+    return list(zip(utt_ids, features))
+
+
+def _iter_gpu_fbank_features(wav_groups: List[List[Tuple]], batch_size: int):
+    # Batches are flushed when full or when the sample rate changes
+    batch = []
+    for waveforms in _iter_prefetched(_read_wav, wav_groups):
+        for utt_id, sample_rate, waveform in waveforms:
+            if len(batch) == batch_size or (
+                len(batch) > 0 and batch[0][1] != sample_rate
+            ):
+                yield from _extract_gpu_batch(batch)
+                batch = []
+            batch.append((utt_id, sample_rate, waveform))
+    if len(batch) > 0:
+        yield from _extract_gpu_batch(batch)
+
+
+def iter_fbank_features(
+    dataset: MUSTC, n_workers: int, gpu_batch_size: int = 0
+):
+    wav_groups = [
+        list(g) for _, g in groupby(
+            sorted(dataset.data, key=itemgetter(0)), key=itemgetter(0)
+        )
+    ]
+    if gpu_batch_size > 0:
+        assert torch.cuda.is_available(), "--gpu-batch-size requires CUDA"
+        yield from _iter_gpu_fbank_features(wav_groups, gpu_batch_size)
+    elif n_workers > 1:
+        # One thread per worker, the pool provides the parallelism
+        with mp.Pool(
+            n_workers, initializer=_init_worker, initargs=(1,)
+        ) as pool:
+            for outputs in pool.imap_unordered(_extract_wav, wav_groups):
+                yield from outputs
+    else:
+        for waveforms in _iter_prefetched(_read_wav, wav_groups):
+            for utt_id, sample_rate, waveform in waveforms:
+                yield utt_id, extract_fbank_features(waveform, sample_rate)
+
+
+def _process_one_lang(lang: str, args, n_workers: int) -> None:
     root = Path(args.data_root).absolute()
-    for lang in set(args.lang):
-        cur_root = root / f"en-{lang}"
-        if not cur_root.is_dir():
-            print(f"{cur_root.as_posix()} does not exist. Skipped.")
-            continue
-        # Set output directory
-        output_root = cur_root
-        if args.output != None:
-            output_root = Path(args.output).absolute() / f"en-{lang}"
-
-        # Pack features into ZIP
-        zip_path = output_root / "fbank80.zip"
-
-        if not zip_path.exists():
-            # Extract features
-            with TemporaryDirectory() as tmpdir:
-                feature_root = Path(tmpdir).absolute() / "fbank80"
-                feature_root.mkdir(exist_ok=True)
-                for split in MUSTC.SPLITS:
-                    print(f"Fetching split {split}...")
-                    dataset = MUSTC(root.as_posix(), lang, split)
-                    print("Extracting log mel filter bank features...")
-                    if split == 'train' and args.cmvn_type == "global":
-                        print("And estimating cepstral mean and variance stats...")
-                        gcmvn_feature_list = []
-
-                    for waveform, sample_rate, _, _, _, utt_id in tqdm(dataset):
-                        features = extract_fbank_features(waveform, sample_rate)
-
-                        np.save(
-                            (feature_root / f"{utt_id}.npy").as_posix(),
-                            features
-                        )
-
-                        if split == 'train' and args.cmvn_type == "global":
-                            if len(gcmvn_feature_list) < args.gcmvn_max_num:
-                                gcmvn_feature_list.append(features)
-
-                    if split == 'train' and args.cmvn_type == "global":
-                        # Estimate and save cmv
-                        stats = cal_gcmvn_stats(gcmvn_feature_list)
-                        with open(output_root / "gcmvn.npz", "wb") as f:
-                            np.savez(f, mean=stats["mean"], std=stats["std"])
-
-                print("ZIPing features...")
-                create_zip(feature_root, zip_path)
-
-                ## Clean up
-                #shutil.rmtree(feature_root)
+    cur_root = root / f"en-{lang}"
+    if not cur_root.is_dir():
+        print(f"{cur_root.as_posix()} does not exist. Skipped.")
+        return
+    # Set output directory
+    output_root = cur_root
+    if args.output != None:
+        output_root = Path(args.output).absolute() / f"en-{lang}"
 
-        print("Fetching ZIP manifest...")
-        zip_manifest = get_zip_manifest(zip_path)
-        # Generate TSV manifest
-        print("Generating manifest...")
-        train_text_asr = []
-        train_text_st = []
-        for split in MUSTC.SPLITS:
-            is_train_split = split.startswith("train")
-            manifest = {c: [] for c in MANIFEST_COLUMNS}
-            src_utts = []
-            tgt_utts = []
-            dataset = MUSTC(args.data_root, lang, split)
-            for wav, sr, src_utt, tgt_utt, speaker_id, utt_id in tqdm(dataset):
-                manifest["id"].append(utt_id)
-                manifest["audio"].append(zip_manifest[utt_id])
-                duration_ms = int(wav.size(1) / sr * 1000)
-                manifest["n_frames"].append(int(1 + (duration_ms - 25) / 10))
-                src_utts.append(src_utt)
-                tgt_utts.append(tgt_utt)
-                manifest["speaker"].append(speaker_id)
-            if is_train_split:
-                train_text_asr.extend(src_utts)
-                train_text_st.extend(tgt_utts)
-
-            for task in set(args.task):
-                manifest["tgt_text"] = src_utts if task == "asr" else tgt_utts
-                df = pd.DataFrame.from_dict(manifest)
-                df = filter_manifest_df(df, is_train_split=is_train_split)
-                save_df_to_tsv(df, output_root / f"{split}_{task}.tsv")
-
-        for task in set(args.task):
-            # Generate vocab
-            vocab_size = args.vocab_size
-            if task == "asr":
-                train_text = train_text_asr
-                if args.vocab_size_asr > 0: vocab_size = args.vocab_size_asr
-            elif task == "st":
-                train_text = train_text_st
-                if args.vocab_size_st > 0: vocab_size = args.vocab_size_st
-            v_size_str = "" if args.vocab_type == "char" else str(vocab_size)
-            spm_filename_prefix = f"spm_{args.vocab_type}{v_size_str}_{task}"
-            with NamedTemporaryFile(mode="w") as f:
-                for t in train_text:
-                    f.write(t + "\n")
-                gen_vocab(
-                    Path(f.name),
-                    output_root / spm_filename_prefix,
-                    args.vocab_type,
-                    vocab_size,
+    datasets = {}
+    for split in MUSTC.SPLITS:
+        print(f"Fetching split {split}...")
+        datasets[split] = MUSTC(root.as_posix(), lang, split)
+
+    # Extract features and pack them into ZIP
+    zip_path = output_root / "fbank80.zip"
+
+    if not zip_path.exists():
+        output_root.mkdir(parents=True, exist_ok=True)
+        # Features are streamed straight into the archive, so write it
+        # under a temporary name until every split is done
+        partial_zip_path = zip_path.with_name(zip_path.name + ".part")
+        zip_manifest = {}
+        zip_index = {c: [] for c in ZIP_INDEX_COLUMNS}
+        with zipfile.ZipFile(
+            partial_zip_path, "w", compression=zipfile.ZIP_STORED,
+            allowZip64=True
+        ) as zip_file:
+            for split, dataset in datasets.items():
+                print(
+                    "Extracting log mel filter bank features for split "
+                    f"{split}..."
                 )
-            # Generate config YAML
-            gen_config_yaml(
-                output_root,
-                spm_filename_prefix + ".model",
-                yaml_filename=f"config_{task}.yaml",
-                specaugment_policy="lb",
-                cmvn_type=args.cmvn_type,
-                gcmvn_path=(
-                    output_root / "gcmvn.npz" if args.cmvn_type == "global"
-                    else None
-                ),
+                is_gcmvn_split = (
+                    split == 'train' and args.cmvn_type == "global"
+                )
+                if is_gcmvn_split:
+                    print("And estimating cepstral mean and variance stats...")
+                    gcmvn_stats = GcmvnStatsAccumulator()
+                    # Features may arrive out of order, so pick the subset by
+                    # dataset position rather than by arrival
+                    gcmvn_utt_ids = {
+                        d[-1] for d in dataset.data[:args.gcmvn_max_num]
+                    }
+
+                for utt_id, features in tqdm(
+                    iter_fbank_features(
+                        dataset, n_workers, args.gpu_batch_size
+                    ),
+                    total=len(dataset)
+                ):
+                    _features = np.ascontiguousarray(
+                        features, dtype=args.feature_dtype
+                    )
+                    offset, file_size = add_npy_to_zip(
+                        zip_file, f"{utt_id}.npy", _features
+                    )
+                    zip_manifest[utt_id] = (
+                        f"{zip_path.as_posix()}:{offset}:{file_size}"
+                    )
+                    # The array data is at the end of the NPY entry
+                    zip_index["id"].append(utt_id)
+                    zip_index["offset"].append(
+                        offset + file_size - _features.nbytes
+                    )
+                    zip_index["n_frames"].append(_features.shape[0])
+                    zip_index["n_mels"].append(_features.shape[1])
+                    zip_index["dtype"].append(_features.dtype.str)
+                    if is_gcmvn_split and utt_id in gcmvn_utt_ids:
+                        gcmvn_stats.update(features)
+
+                if is_gcmvn_split:
+                    # Estimate and save cmv
+                    stats = gcmvn_stats.get_stats()
+                    with open(output_root / "gcmvn.npz", "wb") as f:
+                        np.savez(f, mean=stats["mean"], std=stats["std"])
+        partial_zip_path.rename(zip_path)
+        save_df_to_tsv(
+            pd.DataFrame.from_dict(zip_index),
+            output_root / "fbank80_index.tsv"
+        )
+    else:
+        print("Fetching ZIP manifest...")
+        zip_manifest, _ = get_zip_manifest(zip_path)
+    # Generate TSV manifest
+    print("Generating manifest...")
+    tasks = sorted(set(args.task))
+    train_text_asr = []
+    train_text_st = []
+    for split, dataset in datasets.items():
+        is_train_split = split.startswith("train")
+        # Fill preallocated columns instead of appending to per-column lists
+        n_utts = len(dataset)
+        manifest = {
+            c: np.empty(n_utts, dtype=np.int32 if c == "n_frames" else object)
+            for c in MANIFEST_COLUMNS if c != "tgt_text"
+        }
+        src_utts = np.empty(n_utts, dtype=object)
+        tgt_utts = np.empty(n_utts, dtype=object)
+        for i, (utt_id, n_samples, sr, src_utt, tgt_utt, speaker_id) in tqdm(
+            enumerate(dataset.iter_meta()), total=n_utts
+        ):
+            manifest["id"][i] = utt_id
+            manifest["audio"][i] = zip_manifest[utt_id]
+            duration_ms = n_samples * 1000 // sr
+            manifest["n_frames"][i] = 1 + (duration_ms - 25) // 10
+            src_utts[i] = src_utt
+            tgt_utts[i] = tgt_utt
+            manifest["speaker"][i] = speaker_id
+        if is_train_split:
+            train_text_asr.extend(src_utts)
+            train_text_st.extend(tgt_utts)
+
+        # Tasks only differ in the target text: build the other columns and
+        # evaluate the speech filters once
+        speech_df = pd.DataFrame(
+            {c: manifest[c] for c in MANIFEST_COLUMNS if c != "tgt_text"}
+        )
+        speech_filters = get_manifest_speech_filters(
+            speech_df, is_train_split=is_train_split
+        )
+        for task in tasks:
+            df = speech_df.assign(
+                tgt_text=src_utts if task == "asr" else tgt_utts
+            )[MANIFEST_COLUMNS]
+            df = filter_manifest_df(
+                df, is_train_split=is_train_split,
+                speech_filters=speech_filters
             )
+            save_df_to_tsv(df, output_root / f"{split}_{task}.tsv")
+
+    for task in tasks:
+        # Generate vocab
+        vocab_size = args.vocab_size
+        if task == "asr":
+            train_text = train_text_asr
+            if args.vocab_size_asr > 0: vocab_size = args.vocab_size_asr
+        elif task == "st":
+            train_text = train_text_st
+            if args.vocab_size_st > 0: vocab_size = args.vocab_size_st
+        v_size_str = "" if args.vocab_type == "char" else str(vocab_size)
+        spm_filename_prefix = f"spm_{args.vocab_type}{v_size_str}_{task}"
+        gen_vocab(
+            None,
+            output_root / spm_filename_prefix,
+            args.vocab_type,
+            vocab_size,
+            sentences=train_text,
+        )
+        # Generate config YAML
+        gen_config_yaml(
+            output_root,
+            spm_filename_prefix + ".model",
+            yaml_filename=f"config_{task}.yaml",
+            specaugment_policy="lb",
+            cmvn_type=args.cmvn_type,
+            gcmvn_path=(
+                output_root / "gcmvn.npz" if args.cmvn_type == "global"
+                else None
+            ),
+        )
+
+
+def process(args):
+    langs = sorted(set(args.lang))
+    if len(langs) == 1:
+        _process_one_lang(langs[0], args, args.n_workers)
+        return
+    # Languages share nothing but the input root, so process them in
+    # parallel and split the feature extraction workers between them. Spawned
+    # (non-daemonic) executor processes may start their own pools.
+    n_workers = max(1, args.n_workers // len(langs))
+    with ProcessPoolExecutor(
+        max_workers=min(len(langs), os.cpu_count()),
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(os.cpu_count() // len(langs),),
+    ) as executor:
+        futures = [
+            executor.submit(_process_one_lang, lang, args, n_workers)
+            for lang in langs
+        ]
+        for future in futures:
+            future.result()
 
 
 def main():
@@ -242,6 +446,19 @@ def main():
                             "Maximum number of sentences to use to estimate"
                             "global mean and variance"
                             ))
+    parser.add_argument("--feature-dtype", default="float16",
+                        choices=["float32", "float16"],
+                        help=(
+                            "Data type of the stored features (loaded back as "
+                            "float32 by the speech-to-text dataset)"
+                        ))
+    parser.add_argument("--n-workers", default=1, type=int,
+                        help="Number of processes for feature extraction")
+    parser.add_argument("--gpu-batch-size", default=0, type=int,
+                        help=(
+                            "Extract features on GPU in batches of this many "
+                            "utterances (0 to extract on CPU)"
+                        ))
     args = parser.parse_args()
 
     process(args)
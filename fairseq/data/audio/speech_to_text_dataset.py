@@ -265,6 +265,8 @@ class SpeechToTextDataset(FairseqDataset):
                 with torch.no_grad():
                     source = F.layer_norm(source, source.shape)
         else:
+            # Features may be stored in half precision on disk
+            source = source.astype(np.float32, copy=False)
             if self.feature_transforms is not None:
                 source = self.feature_transforms(source)
             source = torch.from_numpy(source).float()
@@ -0,0 +1,146 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import csv
+import io
+import tempfile
+import unittest
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from examples.speech_to_text import data_utils
+
+try:
+    import torchaudio.compliance.kaldi as ta_kaldi
+
+    has_torchaudio = True
+except ImportError:
+    has_torchaudio = False
+
+
+class TestS2TDataUtils(unittest.TestCase):
+    @unittest.skipIf(
+        not (data_utils.has_numba and has_torchaudio),
+        "Numba and torchaudio are required",
+    )
+    def test_numba_fbank_matches_torchaudio(self):
+        import torch
+
+        rng = np.random.RandomState(0)
+        for sample_rate, n_samples in [(16000, 16000), (8000, 4321)]:
+            waveform = rng.uniform(-1, 1, (1, n_samples)) * (2 ** 15)
+            waveform = waveform.astype(np.float32)
+            features = data_utils._get_numba_fbank(waveform, sample_rate, 80)
+            expected = ta_kaldi.fbank(
+                torch.from_numpy(waveform), num_mel_bins=80,
+                sample_frequency=sample_rate
+            ).numpy()
+            self.assertEqual(features.shape, expected.shape)
+            np.testing.assert_allclose(features, expected, atol=1e-3)
+
+    @unittest.skipIf(not has_torchaudio, "torchaudio is required")
+    def test_fbank_features_batch_matches_torchaudio(self):
+        import torch
+
+        rng = np.random.RandomState(0)
+        # The 100-sample waveform is shorter than one 25ms window
+        waveforms = [
+            torch.from_numpy(rng.uniform(-1, 1, (1, n)).astype(np.float32))
+            for n in [16000, 4321, 100, 12345]
+        ]
+        features = data_utils.extract_fbank_features_batch(
+            waveforms, 16000, n_mel_bins=80, device="cpu"
+        )
+        self.assertEqual(len(features), len(waveforms))
+        for waveform, _features in zip(waveforms, features):
+            if waveform.shape[1] < 400:
+                # torchaudio rejects it, but no frame fits in the waveform
+                self.assertEqual(_features.shape, (0, 80))
+                continue
+            expected = ta_kaldi.fbank(
+                waveform * (2 ** 15), num_mel_bins=80, sample_frequency=16000
+            ).numpy()
+            self.assertEqual(_features.shape, expected.shape)
+            np.testing.assert_allclose(_features, expected, atol=1e-3)
+
+    def test_gcmvn_stats_accumulator_matches_cal_gcmvn_stats(self):
+        rng = np.random.RandomState(0)
+        features_list = [
+            (rng.randn(n_frames, 80) * 3 + 5).astype(np.float32)
+            for n_frames in [17, 0, 1, 250, 64]
+        ]
+        accumulator = data_utils.GcmvnStatsAccumulator()
+        with self.assertRaises(ValueError):
+            accumulator.get_stats()
+        for features in features_list:
+            accumulator.update(features)
+        stats = accumulator.get_stats()
+        expected = data_utils.cal_gcmvn_stats(features_list)
+        for k in ["mean", "std"]:
+            self.assertEqual(stats[k].dtype, np.float32)
+            np.testing.assert_allclose(stats[k], expected[k], rtol=1e-5, atol=1e-5)
+
+    @unittest.skipIf(not data_utils.has_pyarrow, "pyarrow>=12 is required")
+    def test_save_df_to_tsv_pyarrow_matches_pandas(self):
+        manifest = pd.DataFrame({
+            "id": ["ted_1_0", "ted_1_1", "ted_2_0"],
+            "audio": ["fbank80.zip:10:2000", "fbank80.zip:2010:64", "a b:1:2"],
+            "n_frames": [123, 1, 4567],
+            "tgt_text": ["Hallo Welt.", "", "Grüße, 'ok' — ja?"],
+            "speaker": ["spk.1", "spk.1", "spk.2"],
+        })
+        escaped = manifest.assign(tgt_text=['Er sagte: "Hi"', "a\tb", "c\\d"])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for df, is_plain in [(manifest, True), (escaped, False)]:
+                self.assertEqual(
+                    data_utils._get_plain_tsv_table(df) is not None, is_plain
+                )
+                path = Path(tmp_dir) / "manifest.tsv"
+                data_utils.save_df_to_tsv(df, path)
+                expected = df.to_csv(
+                    sep="\t", header=True, index=False, escapechar="\\",
+                    quoting=csv.QUOTE_NONE,
+                )
+                self.assertEqual(path.read_bytes(), expected.encode("utf-8"))
+                pd.testing.assert_frame_equal(
+                    data_utils.load_df_from_tsv(path), df
+                )
+            # Non-string column labels are written as by `to_csv`
+            df = pd.DataFrame({0: ["a", "b"], 1: [1, 2]})
+            path = Path(tmp_dir) / "int_columns.tsv"
+            data_utils.save_df_to_tsv(df, path)
+            self.assertEqual(path.read_text(), "0\t1\na\t1\nb\t2\n")
+
+    def test_add_npy_to_zip_matches_zip_manifest(self):
+        rng = np.random.RandomState(0)
+        arrays = {
+            f"utt_{i}": rng.randn(n_frames, 80).astype(dtype)
+            for i, (n_frames, dtype) in enumerate(
+                [(5, np.float32), (1, np.float16), (321, np.float32)]
+            )
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            zip_path = Path(tmp_dir) / "fbank80.zip"
+            expected = {}
+            with zipfile.ZipFile(
+                zip_path, "w", compression=zipfile.ZIP_STORED
+            ) as zip_file:
+                for utt_id, array in arrays.items():
+                    offset, file_size = data_utils.add_npy_to_zip(
+                        zip_file, f"{utt_id}.npy", array
+                    )
+                    expected[utt_id] = f"{zip_path.as_posix()}:{offset}:{file_size}"
+            paths, lengths = data_utils.get_zip_manifest(zip_path)
+            self.assertEqual(paths, expected)
+            zip_bytes = zip_path.read_bytes()
+            for utt_id, array in arrays.items():
+                self.assertEqual(lengths[utt_id], array.shape[0])
+                _, offset, file_size = paths[utt_id].rsplit(":", 2)
+                offset, file_size = int(offset), int(file_size)
+                loaded = np.load(io.BytesIO(zip_bytes[offset:offset + file_size]))
+                np.testing.assert_array_equal(loaded, array)